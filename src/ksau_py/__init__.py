@@ -16,12 +16,24 @@
 
 import asyncio
 import functools
-from collections.abc import Callable
+import sys
+from collections.abc import Callable, Coroutine
 from typing import Any
 
 from rich.console import Console
 from typer import Typer
 
+from ksau_py.ksau_api import close_session
+
+# uvloop (winloop on Windows) is an optional, faster drop-in for the default event loop
+try:
+    if sys.platform == "win32":
+        from winloop import new_event_loop
+    else:
+        from uvloop import new_event_loop
+except ImportError:
+    new_event_loop = None
+
 REMOTES: list[str] = [
     "hakimionedrive",
     "saurajcf",
@@ -32,11 +44,28 @@ app = Typer(name="ksau-py")
 console: Console = Console()
 
 
+def run(main: Coroutine) -> Any:  # noqa: ANN401
+    """Run a coroutine to completion on uvloop/winloop if installed, or on the default event loop otherwise."""
+    # asyncio.Runner, which lets us pick the event loop, only exists since Python 3.11
+    if new_event_loop is None or sys.version_info < (3, 11):
+        return asyncio.run(main)
+
+    with asyncio.Runner(loop_factory=new_event_loop) as runner:
+        return runner.run(main)
+
+
 def coro(f: Callable) -> Callable:
     """Decorator to run async functions in click/typer commands."""
 
+    async def run_command(*args: Any, **kwargs: Any) -> Any:  # noqa: ANN401
+        try:
+            return await f(*args, **kwargs)
+        finally:
+            # The shared HTTP session is bound to this event loop, so close it before the loop goes away
+            await close_session()
+
     @functools.wraps(f)
     def wrapper(*args: Any, **kwargs: Any) -> Any:  # noqa: ANN401
-        return asyncio.run(f(*args, **kwargs))
+        return run(run_command(*args, **kwargs))
 
     return wrapper
@@ -15,137 +15,997 @@
 # limitations under the License.
 
 import base64
-from asyncio import Task, wait
-from collections.abc import Callable
+import hashlib
+import json
+import os
+import random
+import sys
+from asyncio import Condition, Future, Queue, Task, create_task, gather, get_running_loop, shield, sleep
+from asyncio import TimeoutError as AsyncioTimeoutError
+from collections import deque
+from collections.abc import AsyncGenerator, Callable
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
 from pathlib import Path
+from threading import Lock
+from time import monotonic
+from typing import Annotated
 
 import click
-from aiohttp import ClientSession
-from anyio import open_file
+from aiohttp import ClientConnectionError, ClientError, ClientPayloadError, ClientSession
+from aiohttp.abc import AbstractStreamWriter
+from aiohttp.payload import Payload
 from quickxorhash import quickxorhash
 from rich.progress import Progress
+from typer import Argument, Option
 
 from ksau_py import REMOTES, app, console, coro
-from ksau_py.ksau_api import create_upload_session, get_upload_token
+from ksau_py.ksau_api import (
+    BATCH_MAX_REQUESTS,
+    SIMPLE_UPLOAD_LIMIT,
+    GraphRequestError,
+    TokenResponse,
+    begin_upload,
+    get_missing_ranges,
+    get_session,
+    get_upload_token,
+    upload_files_batch,
+    upload_small_file,
+    with_upload_token,
+)
+
+# Graph documents that upload session fragments must arrive in order, so chunks
+# are only sent in parallel when explicitly asked for.
+CHUNK_CONCURRENCY: int = 1
+# How many files of a batch are uploaded at the same time
+FILE_CONCURRENCY: int = 4
+
+MIB: int = 1024 * 1024
+# Graph upload sessions only accept chunks that are a multiple of 320 KiB
+CHUNK_ALIGNMENT: int = 320 * 1024
+# Graph rejects chunks of 60 MiB or more, this is the largest aligned size below that
+MAX_CHUNK_SIZE: int = 60 * MIB - CHUNK_ALIGNMENT
+MIN_CHUNK_SIZE: int = 5 * MIB
+CHUNK_TARGET_PARTS: int = 100
+# Picked chunks stay at or below this size when several are sent at once, see MAX_EARLY_BYTES
+MAX_PARALLEL_CHUNK_SIZE: int = 10 * MIB
+
+# Chunk bodies are streamed from disk in blocks of this size
+STREAM_BLOCK_SIZE: int = 256 * 1024
+# How many blocks may wait for the hash thread before the upload waits for it
+HASH_BACKLOG: int = 16
+# With parallel chunks, blocks of later chunks wait in memory until the earlier chunks are hashed. Up to
+# (concurrency - 1) chunks, and at least this many bytes, are kept so that sending never waits for the hash order.
+# Past that the later chunks pause sending until the earlier ones catch up.
+MAX_EARLY_BYTES: int = 8 * MIB
+
+# Chunks answered with these are sent again, after Retry-After if Graph gives one or an exponential backoff
+RETRYABLE_STATUSES: tuple[int, ...] = (408, 429, 500, 502, 503, 504)
+MAX_CHUNK_ATTEMPTS: int = 5
+MAX_BACKOFF: float = 60.0
+
+# Graph answers a chunk it has already received, e.g. when only the response to it got lost, with this status
+RANGE_NOT_SATISFIABLE: int = 416
+# Graph answers with this for an upload session that is gone, because the upload completed or the session expired
+SESSION_NOT_FOUND: int = 404
+
+# Files up to this size are uploaded together in $batch requests of up to BATCH_SIZE_LIMIT bytes, as sending them
+# one request each is dominated by per-request overhead
+BATCH_FILE_LIMIT: int = MIB
+BATCH_SIZE_LIMIT: int = 4 * MIB
+
+# Upload sessions are remembered in this folder of the user's cache directory, so an interrupted upload can be resumed
+UPLOAD_STATE_DIR: str = "ksau-py/uploads"
+
+# Seconds between progress callbacks, redrawing faster than this isn't visible anyway
+PROGRESS_INTERVAL: float = 0.1
 
 progress: Progress = Progress(console=console)
+# A quickxorhash object isn't thread-safe, so all hashing happens on this single thread
+hash_executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="quickxorhash")
 
 
+# Typer builds arguments and options from the signature and ignores click decorators, so they are declared here
 @app.command("upload")
-@click.argument("remote_path", type=str)
-@click.argument("remote", type=click.Choice(REMOTES))
-@click.argument("files", nargs=-1, type=click.Path(exists=True, dir_okay=False, resolve_path=True))
-@click.option("-c", "--chunk-size", type=int, default=5, is_flag=True)
 @coro
-async def upload(remote_path: str, remote: str, files: list[str], chunk_size: int = 5) -> None:
+async def upload(
+    remote_path: str,
+    remote: Annotated[str, Argument(click_type=click.Choice(REMOTES))],
+    files: Annotated[list[str], Argument(click_type=click.Path(exists=True, dir_okay=False, resolve_path=True))],
+    chunk_size: Annotated[
+        int | None,
+        Option(
+            "-c",
+            "--chunk-size",
+            help="Upload chunk size in MB, a multiple of 320 KiB below 60 MiB (5, 10, ..., 55) as Graph requires. "
+            "Picked from the file size if not given.",
+        ),
+    ] = None,
+    concurrency: Annotated[
+        int,
+        Option(
+            "-j",
+            "--concurrency",
+            help="How many chunks of a file to upload at once. Chunks ahead of the one being hashed are held in "
+            "memory, up to (concurrency - 1) x chunk size, so picked chunks are at most 10 MiB when this is above 1.",
+        ),
+    ] = CHUNK_CONCURRENCY,
+) -> None:
     """Upload a file to remote storage.
 
     Arguments:
         remote_path(str): Destination path in remote storage
         remote(str): Remote storage to use (oned, hakimidrive, or saurajcf)
         files(list[str]): List of files to be uploaded.
-        chunk_size(int): Upload chunk size in MB (default: 5)
+        chunk_size(int): Upload chunk size in MB, must be a multiple of 320 KiB below 60 MiB (5, 10, ..., 55)
+            as Graph requires (default: picked from the file size)
+        concurrency(int): How many chunks of a file to upload at once. Graph documents that chunks must arrive
+            in order, only raise this for remotes known to accept out-of-order chunks. Up to (concurrency - 1)
+            chunks are held in memory while the one before them is hashed (default: 1)
     """
-    progress.start()
-    tasks: list[Task] = [Task(upload_handler(remote_path, remote, file, chunk_size)) for file in files]
-    await wait(tasks)
-
-
-async def upload_handler(remote_path: str, remote: str, file_path: str, chunk_size: int = 5) -> None:
+    check_upload_options(chunk_size, concurrency)
+    groups, failed = await get_running_loop().run_in_executor(None, group_files, files)
+
+    queue: Queue[list[tuple[str, os.stat_result]]] = Queue()
+    for group in groups:
+        queue.put_nowait(group)
+
+    async def worker() -> None:
+        while not queue.empty():
+            group = queue.get_nowait()
+            if len(group) > 1:
+                # Files Graph didn't take as part of the batch go back in the queue, to be uploaded one by one
+                for file in await batch_upload_handler(remote_path, remote, group):
+                    queue.put_nowait([file])
+                continue
+
+            file_path, stat = group[0]
+            try:
+                await upload_handler(remote_path, remote, file_path, chunk_size, concurrency, stat=stat)
+            except click.Abort:
+                # upload_handler already reported the error, carry on with the other files
+                failed.append(file_path)
+
+    # All files share the module-level progress bar, so there is a single live display to start and stop
+    with progress:
+        await gather(*(worker() for _ in range(min(len(groups), FILE_CONCURRENCY))))
+
+    if failed:
+        raise click.Abort
+
+
+def check_upload_options(chunk_size: int | None, concurrency: int) -> None:
+    """Raise click.BadParameter for a --chunk-size or --concurrency Graph wouldn't work with."""
+    if chunk_size is not None:
+        try:
+            check_chunk_size(chunk_size * MIB)
+        except ValueError as e:
+            msg = "Chunk size must be a multiple of 320 KiB below 60 MiB (5, 10, ..., 55 MB)"
+            raise click.BadParameter(msg, param_hint="--chunk-size") from e
+
+    if concurrency < 1:
+        msg = "Concurrency must be at least 1"
+        raise click.BadParameter(msg, param_hint="--concurrency")
+
+
+async def upload_handler(  # noqa: PLR0913
+    remote_path: str,
+    remote: str,
+    file_path: str,
+    chunk_size: int | None = None,
+    concurrency: int = CHUNK_CONCURRENCY,
+    *,
+    stat: os.stat_result | None = None,
+) -> None:
     """Upload a file to remote storage.
 
     Arguments:
         remote_path(str): Destination path in remote storage
         remote(str): Remote storage to use (oned, hakimidrive, or saurajcf)
         file_path(str): Path to file to be uploaded
-        chunk_size(int): Upload chunk size in MB (default: 5)
+        chunk_size(int): Upload chunk size in MB (default: picked from the file size)
+        concurrency(int): How many chunks to upload at once (default: 1)
+        stat(os.stat_result): Result of stat on the file if already known (default: looked up)
     """
     try:
-        token = await get_upload_token(remote)
         local_file = Path(file_path)
-        remote_dir = remote_path.strip("/")
-        new_name = f"{local_file.stem}{local_file.suffix}"
+        if stat is None:
+            stat = await get_running_loop().run_in_executor(None, local_file.stat)
+
+        file_size = stat.st_size
+        final_remote_path = get_remote_file_path(remote_path, local_file)
+
+        upload_task = progress.add_task("[cyan]Uploading...", total=file_size)
+
+        def update_upload_progress(uploaded: int, total: int) -> None:
+            progress.update(upload_task, completed=uploaded, total=total)
+
+        # Upload file, the QuickXorHash is computed along the way and checked against the one Graph reports
+        if file_size <= SIMPLE_UPLOAD_LIMIT:
+            token, quickxor_upload = await upload_whole_file(local_file, remote, final_remote_path)
+            update_upload_progress(file_size, file_size)
+        else:
+            token, quickxor_upload = await upload_with_session(
+                local_file,
+                remote,
+                final_remote_path,
+                stat,
+                chunk_size=chunk_size,
+                concurrency=concurrency,
+                on_progress=update_upload_progress,
+            )
+
+        print_upload_result(token, final_remote_path, quickxor_upload)
 
-        # If remote path is given, append it to the upload root path
-        final_remote_path = f"{remote_dir}/{new_name}" if remote_dir else new_name
+    except (KeyboardInterrupt, SystemExit) as e:
+        console.print("[red]Error: aborted by user[/red]")
+        raise click.Abort from e
 
-        upload_url = await create_upload_session(token.access_token, final_remote_path, token.upload_root_path)
+    except Exception as e:
+        console.print(f"[red]Error: {e}[/red]")
+        raise click.Abort from e
 
-        upload_task = progress.add_task("[cyan]Uploading...", total=100)
-        quickxor_task = progress.add_task("[cyan]Computing QuickXorHash...", total=Path(file_path).stat().st_size)
 
-        def update_quickxor_task(value: int) -> None:
-            progress.update(quickxor_task, completed=value)
+async def batch_upload_handler(
+    remote_path: str, remote: str, files: list[tuple[str, os.stat_result]]
+) -> list[tuple[str, os.stat_result]]:
+    """Upload small files to remote storage together, in a single Graph $batch request.
 
-        def update_upload_progress(value: int) -> None:
-            progress.update(upload_task, completed=value)
+    Arguments:
+        remote_path(str): Destination path in remote storage
+        remote(str): Remote storage to use (oned, hakimidrive, or saurajcf)
+        files(list[tuple[str, os.stat_result]]): Paths to files to be uploaded with their stat, see group_files
 
-        local_hash = await compute_local_quickxorhash(Path(file_path), update_quickxor_task)
-        console.print(f"[cyan]Local file QuickXorHash: [/cyan][bold green]{local_hash}[/bold green]")
+    Returns:
+        list: The files that weren't uploaded, e.g. because Graph throttled them, with their stat.
+    """
+    loop = get_running_loop()
+    local_files = [Path(file_path) for file_path, _ in files]
+    remote_file_paths = [get_remote_file_path(remote_path, local_file) for local_file in local_files]
+    hashing: Future[list[bytes]] | None = None
+    try:
+        contents = await gather(*(loop.run_in_executor(None, local_file.read_bytes) for local_file in local_files))
+
+        # Hash the files while the batch is on its way
+        hashing = gather(*(hash_bytes(data) for data in contents))
+        uploads = list(zip(remote_file_paths, contents, strict=True))
+        responses, token = await with_upload_token(
+            remote, lambda token: upload_files_batch(token.access_token, token.upload_root_path, uploads)
+        )
+        local_hashes = await hashing
+
+    # Whatever went wrong, each file gets another chance on its own, where its errors are reported per file
+    except Exception as e:  # noqa: BLE001
+        if hashing is not None:
+            await gather(hashing, return_exceptions=True)
+        console.print(f"[yellow]Batch upload failed, uploading the files one by one: {e}[/yellow]")
+        return files
+
+    upload_task = progress.add_task(f"[cyan]Uploading {len(files)} files...", total=sum(map(len, contents)))
+    remaining = []
+    for file, remote_file_path, data, local_hash, response in zip(
+        files, remote_file_paths, contents, local_hashes, responses, strict=True
+    ):
+        if not batch_response_ok(local_hash, response):
+            remaining.append(file)
+            continue
+
+        progress.advance(upload_task, len(data))
+        print_upload_result(token, remote_file_path, local_hash)
+
+    return remaining
+
+
+def batch_response_ok(local_hash: bytes, response: dict) -> bool:
+    """Check whether Graph took a file of a $batch request, and with the same QuickXorHash as the local one."""
+    status, item = response.get("status"), response.get("body")
+    if not isinstance(status, int) or not 200 <= status < 300 or not isinstance(item, dict):  # noqa: PLR2004
+        return False
 
-        # Upload file
-        quickxor_upload = await upload_file_in_chunks(file_path, upload_url, chunk_size, update_upload_progress)
+    try:
+        check_remote_hash(local_hash, item)
+    except click.Abort:
+        return False
 
-        # Calculate and display download info
-        base_url = token.base_url.rstrip("/")
-        download_path = f"{final_remote_path}"
-        download_url = f"{base_url}/{download_path}"
+    return True
 
-        console.print("\n[green]✓ Upload completed successfully![/green]")
-        console.print(f"[cyan]✓ QuickXorHash: [/cyan][bold]{quickxor_upload}[/bold]")
-        console.print("\n[bold]Download Information:[/bold]")
-        console.print(f"[yellow]URL:[/yellow] {download_url}")
 
-    except (KeyboardInterrupt, SystemExit) as e:
-        console.print("[red]Error: aborted by user[/red]")
-        raise click.Abort from e
+def print_upload_result(token: TokenResponse, remote_file_path: str, quickxor_upload: bytes) -> None:
+    """Print the QuickXorHash and download URL of an uploaded file."""
+    base_url = token.base_url.rstrip("/")
+    download_url = f"{base_url}/{remote_file_path}"
 
-    except Exception as e:
+    console.print("\n[green]✓ Upload completed successfully![/green]")
+    console.print(f"[cyan]✓ QuickXorHash: [/cyan][bold]{quickxor_upload}[/bold]")
+    console.print("\n[bold]Download Information:[/bold]")
+    console.print(f"[yellow]URL:[/yellow] {download_url}")
+
+
+def get_remote_file_path(remote_path: str, local_file: Path) -> str:
+    """Get the path `local_file` is uploaded to, relative to the upload root path."""
+    remote_dir = remote_path.strip("/")
+
+    # If remote path is given, append it to the upload root path
+    return f"{remote_dir}/{local_file.name}" if remote_dir else local_file.name
+
+
+def group_files(files: list[str]) -> tuple[list[list[tuple[str, os.stat_result]]], list[str]]:
+    """Group files into uploads, small files are grouped to be uploaded together in one $batch request.
+
+    Returns:
+        tuple: Groups of files with their stat, so uploading them needn't stat them again, and the files that
+            couldn't be stat'ed. A group of more than one file is uploaded with batch_upload_handler.
+    """
+    groups = []
+    failed = []
+    batch: list[tuple[str, os.stat_result]] = []
+    batch_size = 0
+    for file in files:
+        stat = stat_file(file)
+        if stat is None:
+            failed.append(file)
+            continue
+
+        size = stat.st_size
+        if size > BATCH_FILE_LIMIT:
+            groups.append([(file, stat)])
+            continue
+
+        if len(batch) == BATCH_MAX_REQUESTS or batch_size + size > BATCH_SIZE_LIMIT:
+            groups.append(batch)
+            batch, batch_size = [], 0
+
+        batch.append((file, stat))
+        batch_size += size
+
+    if batch:
+        groups.append(batch)
+
+    return groups, failed
+
+
+def stat_file(file: str) -> os.stat_result | None:
+    """Stat `file`, reporting the error if that fails (e.g. a mistyped path) so the other files still get uploaded."""
+    try:
+        return Path(file).stat()
+    except OSError as e:
         console.print(f"[red]Error: {e}[/red]")
-        raise click.Abort from e
+        return None
+
+
+async def hash_bytes(data: bytes) -> bytes:
+    """Get the base64 encoded QuickXorHash of `data`."""
+    hasher = OrderedHasher()
+    await hasher.feed(0, data)
+    return await hasher.digest()
+
+
+async def upload_whole_file(local_file: Path, remote: str, remote_file_path: str) -> tuple[TokenResponse, bytes]:
+    """Upload a file of up to SIMPLE_UPLOAD_LIMIT bytes in a single request, which saves creating a session.
+
+    Returns:
+        tuple: The token used for the upload and the base64 encoded QuickXorHash of the file.
+    """
+    data = await get_running_loop().run_in_executor(None, local_file.read_bytes)
+    item, token = await with_upload_token(
+        remote, lambda token: upload_small_file_with_retries(token, remote_file_path, data)
+    )
+
+    local_hash = await hash_bytes(data)
+    check_remote_hash(local_hash, item)
+    return token, local_hash
+
+
+async def upload_small_file_with_retries(token: TokenResponse, remote_file_path: str, data: bytes) -> dict:
+    """Upload `data` with upload_small_file, sending it again while Graph throttles it or fails to take it.
+
+    Returns:
+        dict: The uploaded drive item.
+    """
+    for attempt in range(1, MAX_CHUNK_ATTEMPTS):
+        retry_after, item = await try_upload_small_file(token, remote_file_path, data, attempt)
+        if retry_after is None:
+            return item
+
+        await sleep(retry_after)
+
+    # The last attempt's error isn't caught, it is reported with the file
+    return await upload_small_file(token.access_token, remote_file_path, token.upload_root_path, data)
+
+
+async def try_upload_small_file(
+    token: TokenResponse, remote_file_path: str, data: bytes, attempt: int
+) -> tuple[float | None, dict | None]:
+    """Upload `data` with upload_small_file once.
+
+    Returns:
+        tuple: How long to wait before sending the file again if Graph failed to take it (None otherwise), and
+            the uploaded drive item (None if Graph failed to take it).
+    """
+    try:
+        return None, await upload_small_file(token.access_token, remote_file_path, token.upload_root_path, data)
+    except GraphRequestError as e:
+        if e.status not in RETRYABLE_STATUSES:
+            raise
+        return parse_retry_after(e.retry_after, backoff_delay(attempt)), None
+
+
+async def upload_with_session(  # noqa: PLR0913
+    local_file: Path,
+    remote: str,
+    remote_file_path: str,
+    stat: os.stat_result,
+    *,
+    chunk_size: int | None,
+    concurrency: int,
+    on_progress: Callable[[int, int], None],
+) -> tuple[TokenResponse, bytes]:
+    """Upload a file in chunks through an upload session, resuming the one of an interrupted upload if possible.
+
+    Returns:
+        tuple: The token used for the upload and the base64 encoded QuickXorHash of the file.
+    """
+    loop = get_running_loop()
+
+    # Pick up where an interrupted upload of the same file left off, unless its session expired
+    upload_state = {"remote": remote, "remote_path": remote_file_path, "size": stat.st_size, "mtime": stat.st_mtime_ns}
+    upload_url = await loop.run_in_executor(None, load_upload_state, local_file, upload_state)
+    missing = None
+    if upload_url is not None:
+        try:
+            missing = await get_missing_ranges(upload_url)
+        except (RuntimeError, ClientError):
+            upload_url = None
+
+    if upload_url is None:
+        upload_url, token = await begin_upload(remote, remote_file_path)
+        await loop.run_in_executor(None, save_upload_state, local_file, {**upload_state, "upload_url": upload_url})
+    else:
+        token = await get_upload_token(remote)
+
+    quickxor_upload = await upload_file_in_chunks(
+        str(local_file),
+        upload_url,
+        chunk_size,
+        on_progress,
+        file_size=stat.st_size,
+        concurrency=concurrency,
+        missing=missing,
+    )
+    await loop.run_in_executor(None, clear_upload_state, local_file)
+    return token, quickxor_upload
+
+
+def load_upload_state(local_file: Path, expected: dict) -> str | None:
+    """Get the upload URL saved for `local_file`, if it was saved for the same remote path and file contents."""
+    try:
+        state = json.loads(upload_state_path(local_file).read_text())
+    except (OSError, RuntimeError, ValueError):
+        return None
+
+    if not isinstance(state, dict) or any(state.get(key) != value for key, value in expected.items()):
+        return None
 
+    return state.get("upload_url")
 
-async def compute_local_quickxorhash(file: Path, update_progress: Callable) -> bytes:
-    hash_ = quickxorhash()
-    computed: int = 0
 
-    async with await open_file(file.as_posix(), "rb") as f:
-        while chunk := await f.read(320 * 1024):
-            hash_.update(chunk)
-            computed += len(chunk)
+def save_upload_state(local_file: Path, state: dict) -> None:
+    """Remember the upload session of `local_file`, it is not resumable if that fails (e.g. no home directory)."""
+    # Path.home raises RuntimeError when there is no home directory to find
+    with suppress(OSError, RuntimeError):
+        state_path = upload_state_path(local_file)
+        state_path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        # The upload URL works without a token, so only the user may read it
+        with os.fdopen(os.open(state_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as state_file:
+            state_file.write(json.dumps(state))
 
-            update_progress(computed)
 
-    return base64.b64encode(hash_.digest())
+def clear_upload_state(local_file: Path) -> None:
+    """Forget the upload session of `local_file` once it is done."""
+    with suppress(OSError, RuntimeError):
+        upload_state_path(local_file).unlink(missing_ok=True)
 
 
-async def upload_file_in_chunks(
-    file_path: str, upload_url: str, chunk_size_mb: int = 5, on_progress: Callable | None = None
+def upload_state_path(local_file: Path) -> Path:
+    """Get the file the upload session of `local_file` is remembered in, named after a hash of its path.
+
+    It lives in the user's cache directory rather than next to `local_file`, so the pre-authenticated upload URL
+    isn't left in folders that may be shared or synced.
+    """
+    if sys.platform == "win32":
+        cache_dir = os.environ.get("LOCALAPPDATA") or Path.home() / "AppData" / "Local"
+    else:
+        cache_dir = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+
+    key = hashlib.sha256(os.fsencode(local_file.absolute())).hexdigest()
+    return Path(cache_dir) / UPLOAD_STATE_DIR / f"{key}.json"
+
+
+def plan_chunks(
+    file_size: int, chunk_size: int, missing: list[tuple[int, int | None]] | None = None
+) -> list[tuple[int, int, bool]]:
+    """Split a file into the chunks to upload.
+
+    Returns:
+        list: (offset, length, send) in file order. Ranges outside `missing`, the ones Graph already received, are
+            not sent but still need to be hashed.
+    """
+    plan = []
+    offset = 0
+    for start, end in [(0, None)] if missing is None else missing:
+        stop = file_size if end is None else min(end, file_size)
+        if start > offset:
+            plan.append((offset, start - offset, False))
+
+        plan.extend((chunk, min(chunk_size, stop - chunk), True) for chunk in range(start, stop, chunk_size))
+        offset = max(offset, stop)
+
+    if offset < file_size:
+        plan.append((offset, file_size - offset, False))
+
+    return plan
+
+
+def check_chunk_size(chunk_size: int) -> None:
+    """Raise ValueError unless Graph upload sessions accept chunks of `chunk_size` bytes."""
+    if chunk_size <= 0 or chunk_size % CHUNK_ALIGNMENT:
+        msg = f"Chunk size must be a positive multiple of 320 KiB, got {chunk_size} bytes"
+        raise ValueError(msg)
+
+    if chunk_size > MAX_CHUNK_SIZE:
+        msg = f"Chunk size must be less than 60 MiB, got {chunk_size} bytes"
+        raise ValueError(msg)
+
+
+def pick_chunk_size(file_size: int, concurrency: int = CHUNK_CONCURRENCY) -> int:
+    """Pick an upload chunk size in bytes for a file of `file_size` bytes sent `concurrency` chunks at a time.
+
+    Files are split into about CHUNK_TARGET_PARTS chunks, as few large requests upload faster than many small
+    ones. Chunks are kept between MIN_CHUNK_SIZE and MAX_CHUNK_SIZE, or MAX_PARALLEL_CHUNK_SIZE when chunks are
+    sent in parallel, as the chunks ahead of the one being hashed are held in memory.
+    """
+    largest = MAX_CHUNK_SIZE if concurrency == 1 else MAX_PARALLEL_CHUNK_SIZE
+    aligned = -(-(file_size // CHUNK_TARGET_PARTS) // CHUNK_ALIGNMENT) * CHUNK_ALIGNMENT
+    return max(MIN_CHUNK_SIZE, min(largest, aligned))
+
+
+class OrderedHasher:
+    """Compute a QuickXorHash from blocks that may arrive out of file order.
+
+    Blocks are queued on hash_executor in file order, a block that arrives early waits here until the gap before it
+    is filled. At most `max_early_bytes` are kept waiting, feeding more early blocks waits for the gap to shrink.
+    """
+
+    def __init__(self, max_early_bytes: int = MAX_EARLY_BYTES) -> None:
+        """Create a hasher that expects the block at offset 0 first."""
+        self._hash = quickxorhash()
+        self._offset: int = 0
+        self._early: dict[int, bytes] = {}
+        self._early_bytes: int = 0
+        self._max_early_bytes: int = max_early_bytes
+        self._progressed = Condition()
+        self._queued: deque[Future] = deque()
+
+    async def feed(self, offset: int, block: bytes) -> None:
+        """Add the block that starts at `offset` in the file."""
+        size = len(block)
+        async with self._progressed:
+            # The block that fills the gap is always let in, so the chunk it belongs to can't be held up by later ones
+            await self._progressed.wait_for(
+                lambda: offset <= self._offset or self._early_bytes + size <= self._max_early_bytes
+            )
+
+            # A block that has been hashed or is waiting already is skipped, e.g. a chunk that is being sent again
+            if offset < self._offset or offset in self._early:
+                return
+
+            self._early[offset] = block
+            self._early_bytes += size
+            loop = get_running_loop()
+            while (block := self._early.pop(self._offset, None)) is not None:
+                self._early_bytes -= len(block)
+                self._queued.append(loop.run_in_executor(hash_executor, self._hash.update, block))
+                self._offset += len(block)
+
+            self._progressed.notify_all()
+
+        # Don't let the hash thread fall too far behind the network. The wait is shielded as a dropped connection
+        # cancels the body being sent, and the block must still be hashed for the chunk's retry.
+        while len(self._queued) > HASH_BACKLOG:
+            await shield(self._queued[0])
+            self._queued.popleft()
+
+    async def digest(self) -> bytes:
+        """Wait for the queued blocks to be hashed and return the base64 encoded hash."""
+        while self._queued:
+            await self._queued.popleft()
+
+        return base64.b64encode(self._hash.digest())
+
+
+if sys.platform == "win32":
+    seek_lock: Lock = Lock()
+
+    def pread(fd: int, length: int, offset: int) -> bytes:
+        """Read `length` bytes at `offset` of `fd`, Windows has no os.pread so seek and read under a lock."""
+        with seek_lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            return os.read(fd, length)
+
+else:
+    pread = os.pread
+
+
+def open_for_upload(file_path: str) -> int:
+    """Open `file_path` for reading and return its file descriptor."""
+    fd = os.open(file_path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+    # The file is read front to back, let the kernel read ahead further than it would by default
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+    return fd
+
+
+async def stream_file_range(fd: int, offset: int, length: int, hasher: OrderedHasher) -> AsyncGenerator[bytes, None]:
+    """Yield `length` bytes of `fd` starting at `offset` and feed them to `hasher`.
+
+    Blocks are read with pread on a worker thread, so concurrent chunks can share one file descriptor.
+    The next block is read while the current one is hashed and sent, so at most two STREAM_BLOCK_SIZE blocks are
+    held in memory at a time instead of the whole chunk.
+    """
+    loop = get_running_loop()
+    end = offset + length
+
+    def read_ahead(start: int) -> Future[bytes] | None:
+        return (
+            loop.run_in_executor(None, pread, fd, min(STREAM_BLOCK_SIZE, end - start), start) if start < end else None
+        )
+
+    next_block = read_ahead(offset)
+    try:
+        while next_block is not None:
+            block = await next_block
+            if not block:
+                return
+
+            next_block = read_ahead(offset + len(block))
+            await hasher.feed(offset, block)
+            offset += len(block)
+            yield block
+    finally:
+        # The request was cut short, nobody is waiting for the block read ahead anymore
+        if next_block is not None:
+            next_block.cancel()
+
+
+async def hash_file_range(fd: int, offset: int, length: int, hasher: OrderedHasher) -> None:
+    """Feed `length` bytes of `fd` starting at `offset` to `hasher` without sending them anywhere."""
+    async for _ in stream_file_range(fd, offset, length, hasher):
+        pass
+
+
+class FileRangePayload(Payload):
+    """Request body streaming `length` bytes of `fd` from `offset`.
+
+    Unlike an AsyncIterablePayload it can be written more than once, aiohttp silently sends a PUT again when a
+    kept-alive connection turns out to be closed and would otherwise send an empty body.
+    """
+
+    def __init__(self, fd: int, offset: int, length: int, hasher: OrderedHasher, send_from: int) -> None:
+        """Create a payload for a range of `fd`, blocks read from it are fed to `hasher`.
+
+        The whole range is read and hashed, but only the bytes from `send_from` on are sent. This keeps the blocks
+        fed to `hasher` the same when a retry only sends the part of a chunk that Graph did not receive.
+        """
+        super().__init__((fd, offset, length), content_type="application/octet-stream")
+        self._size = offset + length - send_from
+        self._hasher = hasher
+        self._send_from = send_from
+
+    async def write(self, writer: AbstractStreamWriter) -> None:
+        """Read the range from disk and write it to `writer`."""
+        fd, position, length = self._value
+        async for block in stream_file_range(fd, position, length, self._hasher):
+            skip = max(0, self._send_from - position)
+            if skip < len(block):
+                await writer.write(block[skip:] if skip else block)
+            position += len(block)
+
+    def decode(self, encoding: str = "utf-8", errors: str = "strict") -> str:  # noqa: ARG002
+        """File contents aren't text."""
+        msg = "Unable to decode a file range"
+        raise TypeError(msg)
+
+
+class AdmissionController:
+    """Limit how many chunk uploads may be in flight at once.
+
+    Unlike asyncio.Semaphore, the limit can be changed while uploads are running. It is halved when Graph throttles
+    us and grows back one step per successful upload, up to the limit the controller was created with.
+    """
+
+    def __init__(self, max_active: int) -> None:
+        """Create a controller that admits up to `max_active` uploads at once."""
+        self._active: int = 0
+        self._max: int = max_active
+        self._ceiling: int = max_active
+        self._cond: Condition = Condition()
+
+    async def acquire(self) -> None:
+        """Wait until an upload slot is free and take it."""
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._active < self._max)
+            self._active += 1
+
+    async def release(self) -> None:
+        """Give back an upload slot and wake up one waiter."""
+        async with self._cond:
+            self._active -= 1
+            self._cond.notify(1)
+
+    async def set_max(self, max_active: int) -> None:
+        """Change the number of uploads allowed at once."""
+        async with self._cond:
+            self._max = max_active
+            self._cond.notify_all()
+
+    async def throttled(self) -> None:
+        """Back off after the server asked us to slow down or failed to take a chunk."""
+        await self.set_max(max(1, self._max // 2))
+
+    async def succeeded(self) -> None:
+        """Let one more upload in after a successful one, if we backed off before."""
+        if self._max < self._ceiling:
+            await self.set_max(self._max + 1)
+
+
+def backoff_delay(attempt: int) -> float:
+    """Seconds to wait before retrying after the `attempt`-th failed try, with jitter so chunks don't retry at once."""
+    return min(MAX_BACKOFF, 2.0**attempt) + random.random()  # noqa: S311
+
+
+def parse_retry_after(value: str | None, default: float) -> float:
+    """Parse a Retry-After header in seconds, falling back to `default`."""
+    try:
+        return max(0.0, float(value)) if value is not None else default
+    except ValueError:
+        return default
+
+
+async def send_chunk(  # noqa: PLR0913
+    session: ClientSession,
+    upload_url: str,
+    fd: int,
+    offset: int,
+    length: int,
+    *,
+    send_from: int,
+    headers: dict[str, str],
+    hasher: OrderedHasher,
+    attempt: int,
+) -> tuple[float | None, dict | None]:
+    """PUT one chunk of the file from `send_from` on to the upload session, `headers` describe the range being sent.
+
+    Returns:
+        tuple: How long to wait before sending the chunk again if Graph failed to take it (None otherwise, 0 if
+            Graph already has some of it), and the drive item if this chunk completed the upload (None otherwise).
+    """
+    may_retry = attempt < MAX_CHUNK_ATTEMPTS
+
+    try:
+        async with session.put(
+            upload_url,
+            headers=headers,
+            data=FileRangePayload(fd, offset, length, hasher, send_from),
+        ) as response:
+            if may_retry and response.status in RETRYABLE_STATUSES:
+                return parse_retry_after(response.headers.get("Retry-After"), backoff_delay(attempt)), None
+
+            # An earlier attempt was stored although its response got lost, ask Graph what is still missing
+            if may_retry and response.status == RANGE_NOT_SATISFIABLE:
+                return 0.0, None
+
+            if not response.ok:
+                error_text = await response.text()
+                msg = (
+                    f"Failed to upload chunk {headers['Content-Range']}, status: {response.status}, error: {error_text}"
+                )
+                raise click.Abort(msg)
+
+            # Graph answers the request that completes the file with the resulting drive item
+            if response.status in (200, 201):
+                return None, await response.json()
+
+            return None, None
+
+    except (ClientConnectionError, ClientPayloadError, AsyncioTimeoutError):
+        if not may_retry:
+            raise
+        return backoff_delay(attempt), None
+
+
+def check_remote_hash(local_hash: bytes, item: dict | None) -> None:
+    """Abort if the drive item Graph returned for the upload has a QuickXorHash that differs from the local one."""
+    remote_hash = (item or {}).get("file", {}).get("hashes", {}).get("quickXorHash")
+    if remote_hash is not None and remote_hash != local_hash.decode():
+        msg = f"QuickXorHash mismatch, local: {local_hash.decode()}, remote: {remote_hash}"
+        raise click.Abort(msg)
+
+
+async def chunk_resume_offset(  # noqa: PLR0913
+    session: ClientSession, upload_url: str, offset: int, length: int, current: int, *, final: bool
+) -> int | None:
+    """Ask Graph where to continue sending the chunk at `offset` after an attempt failed.
+
+    `final` tells whether the chunk ends the file, Graph closes the session once it received that chunk.
+
+    Returns:
+        int: The first byte of the chunk Graph is still waiting for, `current` if Graph can't tell, or None if
+            Graph received the whole chunk already.
+    """
+    try:
+        missing = await get_missing_ranges(upload_url, session)
+    except GraphRequestError as e:
+        if e.status != SESSION_NOT_FOUND:
+            return current
+        # Only the response to the chunk that completed the upload got lost, anything sent now would be refused
+        if final:
+            return None
+        raise
+    except (RuntimeError, ValueError, ClientError, AsyncioTimeoutError):
+        return current
+
+    end = offset + length
+    # Graph keeps the part of a fragment it received, so what is left of the chunk runs up to its end
+    return min(
+        (max(start, offset) for start, stop in missing if start < end and (stop is None or stop > offset)), default=None
+    )
+
+
+async def send_chunk_with_retries(  # noqa: PLR0913
+    session: ClientSession,
+    upload_url: str,
+    fd: int,
+    offset: int,
+    length: int,
+    *,
+    file_size: int,
+    hasher: OrderedHasher,
+    admission: AdmissionController,
+) -> dict | None:
+    """Send one chunk until Graph takes it, releasing its slot of `admission` afterwards.
+
+    Returns:
+        dict: The drive item if this chunk completed the upload, None otherwise.
+    """
+    # The headers only change when a retry sends less of the chunk, so they are not built for every attempt.
+    # aiohttp sets Content-Length itself from the size of the FileRangePayload.
+    send_from = offset
+    headers = {"Content-Range": f"bytes {send_from}-{offset + length - 1}/{file_size}"}
+
+    try:
+        for attempt in range(1, MAX_CHUNK_ATTEMPTS + 1):
+            retry_after, item = await send_chunk(
+                session,
+                upload_url,
+                fd,
+                offset,
+                length,
+                send_from=send_from,
+                headers=headers,
+                hasher=hasher,
+                attempt=attempt,
+            )
+            if retry_after is None:
+                await admission.succeeded()
+                return item
+
+            # Fewer chunks are let in while we wait, this one is sent again afterwards
+            if retry_after:
+                await admission.throttled()
+                await sleep(retry_after)
+
+            # Graph may have stored all or part of the failed attempt, sending that again would be refused
+            resume = await chunk_resume_offset(
+                session, upload_url, offset, length, send_from, final=offset + length == file_size
+            )
+            if resume is None:
+                await hash_file_range(fd, offset, length, hasher)
+                await admission.succeeded()
+                return None
+
+            if resume != send_from:
+                send_from = resume
+                headers = {"Content-Range": f"bytes {send_from}-{offset + length - 1}/{file_size}"}
+    finally:
+        await admission.release()
+
+    return None
+
+
+async def upload_file_in_chunks(  # noqa: PLR0913
+    file_path: str,
+    upload_url: str,
+    chunk_size_mb: int | None = None,
+    on_progress: Callable[[int, int], None] | None = None,
+    *,
+    file_size: int | None = None,
+    concurrency: int = CHUNK_CONCURRENCY,
+    session: ClientSession | None = None,
+    missing: list[tuple[int, int | None]] | None = None,
 ) -> bytes:
-    """Upload file in chunks to the specified upload URL."""
-    chunk_size = chunk_size_mb * 1024 * 1024
-    file_size = Path(file_path).stat().st_size
+    """Upload file in chunks to the specified upload URL.
+
+    Up to `concurrency` chunks are sent at once, all of them streamed from one file descriptor.
+    The local QuickXorHash is compared with the one Graph reports for the finished upload.
+    `on_progress` is called with the bytes uploaded so far and the file size, at most every PROGRESS_INTERVAL.
+    Chunks are sent through `session` if given, or through the shared session otherwise.
+    When resuming an upload, only the `missing` ranges (as returned by get_missing_ranges) are sent.
+    `file_size` is looked up if not given, pass it when it is known already to save a stat call.
+    """
+    if file_size is None:
+        file_size = await get_running_loop().run_in_executor(None, os.path.getsize, file_path)
+
+    chunk_size = chunk_size_mb * MIB if chunk_size_mb else pick_chunk_size(file_size, concurrency)
+    check_chunk_size(chunk_size)
     uploaded = 0
-    hash_ = quickxorhash()
-
-    async with ClientSession() as session, await open_file(file_path, "rb") as f:
-        while chunk := await f.read(chunk_size):
-            chunk_end = min(uploaded + chunk_size, file_size)
-            content_range = f"bytes {uploaded}-{chunk_end - 1}/{file_size}"
-
-            # Upload the chunk
-            async with session.put(
-                upload_url, headers={"Content-Range": content_range, "Content-Length": str(len(chunk))}, data=chunk
-            ) as response:
-                if not response.ok:
-                    error_text = await response.text()
-                    msg = f"Failed to upload chunk {content_range}, status: {response.status}, error: {error_text}"
-                    raise click.Abort(msg)
-                hash_.update(chunk)
-
-                uploaded = chunk_end
-                if on_progress:
-                    progress = (uploaded / file_size) * 100
-                    on_progress(round(progress))
-
-    return base64.b64encode(hash_.digest())
+    last_report = monotonic()
+    # Room for every chunk sent ahead of the one being hashed, so they don't pause mid-body waiting for it
+    hasher = OrderedHasher(max(MAX_EARLY_BYTES, (concurrency - 1) * chunk_size))
+    final_item: dict | None = None
+    admission = AdmissionController(concurrency)
+    pending: set[Task] = set()
+
+    def advance(length: int) -> None:
+        nonlocal uploaded, last_report
+
+        # Chunks may finish out of order, so count bytes rather than chunks
+        uploaded += length
+        now = monotonic()
+        if on_progress and (now - last_report >= PROGRESS_INTERVAL or uploaded == file_size):
+            on_progress(uploaded, file_size)
+            last_report = now
+
+    async def put_chunk(session: ClientSession, offset: int, length: int) -> None:
+        nonlocal final_item
+
+        item = await send_chunk_with_retries(
+            session, upload_url, fd, offset, length, file_size=file_size, hasher=hasher, admission=admission
+        )
+        if item is not None:
+            final_item = item
+
+        advance(length)
+
+    session = session or await get_session()
+    # Opening may block too (network mounts, disks spinning up), so it runs off the loop like the reads
+    fd = await get_running_loop().run_in_executor(None, open_for_upload, file_path)
+    try:
+        # A new chunk is started as soon as any running one finishes, not once a whole batch is done
+        for offset, length, send in plan_chunks(file_size, chunk_size, missing):
+            if not send:
+                # Graph already has this range, it is only read for the hash once the chunks before it are hashed
+                await gather(*pending)
+                await hash_file_range(fd, offset, length, hasher)
+                advance(length)
+                continue
+
+            await admission.acquire()
+
+            # Stop handing out chunks as soon as one of them failed, result() re-raises its error
+            for task in [task for task in pending if task.done()]:
+                pending.discard(task)
+                task.result()
+
+            pending.add(create_task(put_chunk(session, offset, length)))
+
+        await gather(*pending)
+    finally:
+        for task in pending:
+            task.cancel()
+        await gather(*pending, return_exceptions=True)
+        os.close(fd)
+
+    local_hash = await hasher.digest()
+    check_remote_hash(local_hash, final_item)
+    return local_hash
@@ -14,12 +14,54 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import base64
+import json
+from asyncio import Lock, gather
+from collections.abc import Awaitable, Callable
 from dataclasses import dataclass
+from http import HTTPStatus
+from time import monotonic
+from typing import TypeVar
+from urllib.parse import quote
 
-from aiohttp import ClientSession
+from aiohttp import ClientError, ClientResponse, ClientSession, ClientTimeout, TCPConnector
+
+T = TypeVar("T")
 
 KSAU_BASE_URL: str = "https://project.ksauraj.eu.org"
 ENDPOINTS = {"upload": "/upload", "token": "/token"}
+GRAPH_BASE_URL: str = "https://graph.microsoft.com/v1.0"
+# Files up to this size can be uploaded with a single PUT instead of an upload session
+SIMPLE_UPLOAD_LIMIT: int = 4 * 1024 * 1024
+# Graph runs at most this many requests of a $batch request
+BATCH_MAX_REQUESTS: int = 20
+# Query string that makes an upload replace an existing file of the same name
+REPLACE_QUERY: str = "@microsoft.graph.conflictBehavior=replace"
+# The createUploadSession request body never changes, so it is serialized once
+CREATE_SESSION_BODY: bytes = json.dumps({"item": {"@microsoft.graph.conflictBehavior": "replace"}}).encode()
+
+# Sending a chunk of up to 60 MiB may take many minutes on a slow or shared uplink, so requests get no overall
+# time limit. Only connecting, and waiting for a response once the request has been sent, are bounded.
+SESSION_TIMEOUT: ClientTimeout = ClientTimeout(total=None, sock_connect=30, sock_read=300)
+
+# Cached tokens are only handed out while they are valid for at least this many seconds
+TOKEN_EXPIRY_MARGIN: int = 60
+
+_session: ClientSession | None = None
+
+
+class GraphRequestError(RuntimeError):
+    """A Graph request was answered with an error status."""
+
+    def __init__(self, msg: str, status: int, retry_after: str | None = None) -> None:
+        """Create the error for a request Graph answered with `status`, and the Retry-After header if it sent one."""
+        super().__init__(msg)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class TokenRejectedError(GraphRequestError):
+    """Graph refused the access token, e.g. because it was revoked before it was due to expire."""
 
 
 @dataclass
@@ -35,46 +77,247 @@ class TokenResponse:
     upload_root_path: str
 
 
-async def get_upload_token(remote: str) -> TokenResponse:
-    """Get upload token from the API."""
+# Upload tokens per remote, along with the monotonic() time they expire at
+_token_cache: dict[str, tuple[TokenResponse, float]] = {}
+_token_locks: dict[str, Lock] = {}
+
+
+async def get_session() -> ClientSession:
+    """Get the HTTP session shared by every request, creating it on first use."""
+    global _session
+    if _session is None or _session.closed:
+        # Keep idle connections around long enough to be reused by the next file of a batch. Nearly every request
+        # goes to the same Graph host, so it gets enough connections for several files with parallel chunks each,
+        # and its address is looked up once per run rather than every 30 seconds.
+        _session = ClientSession(
+            connector=TCPConnector(limit=64, limit_per_host=32, ttl_dns_cache=600, keepalive_timeout=75),
+            timeout=SESSION_TIMEOUT,
+        )
+
+    return _session
+
+
+async def close_session() -> None:
+    """Close the shared HTTP session, if one was created."""
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+
+def get_cached_token(remote: str) -> TokenResponse | None:
+    """Get the cached upload token of `remote`, if it is valid for at least TOKEN_EXPIRY_MARGIN more seconds."""
+    cached = _token_cache.get(remote)
+    if cached is not None and cached[1] - monotonic() > TOKEN_EXPIRY_MARGIN:
+        return cached[0]
+
+    return None
+
+
+async def get_upload_token(
+    remote: str, session: ClientSession | None = None, *, rejected: TokenResponse | None = None
+) -> TokenResponse:
+    """Get upload token from the API.
+
+    Tokens are cached per remote until they are about to expire, so parallel uploads share a single request.
+    `rejected` is a token Graph refused before it was due to expire, it isn't handed out from the cache again.
+    The request goes through `session` if given, or through the shared session otherwise.
+    """
     url = f"{KSAU_BASE_URL}{ENDPOINTS['token']}?remote={remote}"
 
-    async with ClientSession() as session, session.get(url) as response:
-        if not response.ok:
-            error_text = await response.text()
-            msg = f"Failed to get upload token: {error_text}"
-            raise RuntimeError(msg)
+    async with _token_locks.setdefault(remote, Lock()):
+        # A token another request got after the rejected one was refused is used as is
+        cached = get_cached_token(remote)
+        if cached is not None and cached is not rejected:
+            return cached
+
+        session = session or await get_session()
+        async with session.get(url) as response:
+            if not response.ok:
+                error_text = await response.text()
+                msg = f"Failed to get upload token: {error_text}"
+                raise RuntimeError(msg)
+
+            data = await response.json()
+            token = TokenResponse(**data)
+
+        _token_cache[remote] = (token, monotonic() + token.expires_in)
+        return token
+
+
+async def graph_error(response: ClientResponse, action: str) -> GraphRequestError:
+    """Build the error for a failed Graph request, a TokenRejectedError if Graph refused the access token."""
+    error_text = await response.text()
+    msg = f"Failed to {action}: {error_text}"
+    error = TokenRejectedError if response.status == HTTPStatus.UNAUTHORIZED else GraphRequestError
+    return error(msg, response.status, response.headers.get("Retry-After"))
 
-        data = await response.json()
-        return TokenResponse(**data)
 
+def drive_item_path(upload_root_path: str, remote_file_path: str) -> str:
+    """Get the path of `remote_file_path` under `upload_root_path`, quoted to be put in a Graph request URL.
 
-async def create_upload_session(access_token: str, remote_file_path: str, upload_root_path: str) -> str:
-    """Create an upload session for chunked file upload."""
-    # Build the complete remote path using the provided upload_root_path
-    clean_path = f"{upload_root_path.strip('/')}/{remote_file_path}"
-    url = f"https://graph.microsoft.com/v1.0/me/drive/root:/{clean_path}:/createUploadSession"
+    Names may hold characters such as # or ? that would otherwise end the path of the URL.
+    """
+    return quote(f"{upload_root_path.strip('/')}/{remote_file_path}")
+
+
+async def create_upload_session(
+    access_token: str, remote_file_path: str, upload_root_path: str, session: ClientSession | None = None
+) -> str:
+    """Create an upload session for chunked file upload.
+
+    The request goes through `session` if given, or through the shared session otherwise.
+    """
+    url = f"{GRAPH_BASE_URL}/me/drive/root:/{drive_item_path(upload_root_path, remote_file_path)}:/createUploadSession"
     headers = {
         "Authorization": f"Bearer {access_token}",
         "Content-Type": "application/json",
     }
 
-    async with (
-        ClientSession() as session,
-        session.post(
-            url,
-            headers=headers,
-            json={
-                "item": {
-                    "@microsoft.graph.conflictBehavior": "replace",
-                }
-            },
-        ) as response,
-    ):
+    session = session or await get_session()
+    async with session.post(url, headers=headers, data=CREATE_SESSION_BODY) as response:
         if not response.ok:
-            error_text = await response.text()
-            msg = f"Failed to create upload session: {error_text}"
-            raise RuntimeError(msg)
+            raise await graph_error(response, "create upload session")
 
         data = await response.json()
         return data["uploadUrl"]
+
+
+async def upload_small_file(
+    access_token: str, remote_file_path: str, upload_root_path: str, data: bytes, session: ClientSession | None = None
+) -> dict:
+    """Upload a whole file in one request, without an upload session.
+
+    Graph only accepts files up to SIMPLE_UPLOAD_LIMIT bytes this way.
+    The request goes through `session` if given, or through the shared session otherwise.
+
+    Returns:
+        dict: The uploaded drive item.
+    """
+    url = f"{GRAPH_BASE_URL}/me/drive/root:/{drive_item_path(upload_root_path, remote_file_path)}:/content"
+    headers = {
+        "Authorization": f"Bearer {access_token}",
+        "Content-Type": "application/octet-stream",
+    }
+
+    session = session or await get_session()
+    async with session.put(
+        url, headers=headers, params={"@microsoft.graph.conflictBehavior": "replace"}, data=data
+    ) as response:
+        if not response.ok:
+            raise await graph_error(response, "upload file")
+
+        return await response.json()
+
+
+async def upload_files_batch(
+    access_token: str, upload_root_path: str, files: list[tuple[str, bytes]], session: ClientSession | None = None
+) -> list[dict]:
+    """Upload up to BATCH_MAX_REQUESTS small files, given as (remote path, contents), in one $batch request.
+
+    Each file is sent the same way as upload_small_file. Graph may fail some of them while others succeed.
+    The request goes through `session` if given, or through the shared session otherwise.
+
+    Returns:
+        list: The response of each file in the order they were given, as a dict with its "status" and "body".
+    """
+    if len(files) > BATCH_MAX_REQUESTS:
+        msg = f"Graph batches hold at most {BATCH_MAX_REQUESTS} requests, got {len(files)}"
+        raise ValueError(msg)
+
+    requests = [
+        {
+            "id": str(index),
+            "method": "PUT",
+            "url": f"/me/drive/root:/{drive_item_path(upload_root_path, remote_file_path)}:/content?{REPLACE_QUERY}",
+            # Bodies that aren't JSON are sent base64 encoded
+            "headers": {"Content-Type": "application/octet-stream"},
+            "body": base64.b64encode(data).decode(),
+        }
+        for index, (remote_file_path, data) in enumerate(files)
+    ]
+    headers = {"Authorization": f"Bearer {access_token}"}
+
+    session = session or await get_session()
+    async with session.post(f"{GRAPH_BASE_URL}/$batch", headers=headers, json={"requests": requests}) as response:
+        if not response.ok:
+            raise await graph_error(response, "upload files")
+
+        data = await response.json()
+
+    # Graph may answer the requests of a batch in any order
+    responses = {item["id"]: item for item in data.get("responses", [])}
+    return [responses.get(str(index), {"status": 0, "body": None}) for index in range(len(files))]
+
+
+async def warm_up_graph(session: ClientSession) -> None:
+    """Open a connection to Graph ahead of time, so the next request to it skips the DNS lookup and TLS handshake."""
+    try:
+        async with session.head(GRAPH_BASE_URL):
+            pass
+    except ClientError:
+        pass
+
+
+async def begin_upload(
+    remote: str, remote_file_path: str, session: ClientSession | None = None
+) -> tuple[str, TokenResponse]:
+    """Get an upload token and create an upload session for `remote_file_path` on `remote`.
+
+    If the token has to be fetched, a connection to Graph is opened meanwhile so creating the session doesn't wait
+    for it.
+    A token Graph refuses is refreshed once, see with_upload_token.
+    The requests go through `session` if given, or through the shared session otherwise.
+
+    Returns:
+        tuple: The upload URL and the token it was created with.
+    """
+    session = session or await get_session()
+    if get_cached_token(remote) is None:
+        await gather(get_upload_token(remote, session), warm_up_graph(session))
+
+    return await with_upload_token(
+        remote,
+        lambda token: create_upload_session(token.access_token, remote_file_path, token.upload_root_path, session),
+        session,
+    )
+
+
+async def with_upload_token(
+    remote: str, request: Callable[[TokenResponse], Awaitable[T]], session: ClientSession | None = None
+) -> tuple[T, TokenResponse]:
+    """Run `request` with the upload token of `remote`, and once more with a new token if Graph refuses it.
+
+    A token may be revoked before it is due to expire. Requests refused at the same time share the new token.
+    The token request goes through `session` if given, or through the shared session otherwise.
+
+    Returns:
+        tuple: What `request` returned and the token it was run with.
+    """
+    token = await get_upload_token(remote, session)
+    try:
+        return await request(token), token
+    except TokenRejectedError:
+        token = await get_upload_token(remote, session, rejected=token)
+        return await request(token), token
+
+
+async def get_missing_ranges(upload_url: str, session: ClientSession | None = None) -> list[tuple[int, int | None]]:
+    """Get the byte ranges an upload session is still waiting for.
+
+    Ranges are returned as (start, end) with an exclusive end, or None as end when the range runs to the end of
+    the file. The request goes through `session` if given, or through the shared session otherwise.
+    """
+    session = session or await get_session()
+    async with session.get(upload_url) as response:
+        if not response.ok:
+            raise await graph_error(response, "get upload session status")
+
+        data = await response.json()
+
+    ranges = []
+    for expected in data.get("nextExpectedRanges", []):
+        start, _, end = expected.partition("-")
+        ranges.append((int(start), int(end) + 1 if end else None))
+
+    return ranges